@@ -13,7 +13,8 @@ setup(
         'tqdm'
     ],
     extras_require={
-        "test": ["pytest"]
+        "test": ["pytest", "pytest-xdist"],
+        "orjson": ["orjson"]
     },
     package_data={
         "tds_utils": ["templates/*.xml"]
@@ -2,6 +2,7 @@ from tds_utils.aggregation.aggregate import (BaseAggregationCreator, Aggregation
                                              AggregationCreator, NcMLVariable,
                                              create_aggregation)
 from tds_utils.aggregation.dataset_list import DatasetList, AggregatedGlobalAttr
+from tds_utils.aggregation.coord_cache import CoordCache
 from tds_utils.aggregation.readers import BaseDatasetReader, NetcdfDatasetReader
 from tds_utils.aggregation.exceptions import (AggregationError, OverlappingUnitsError,
                                               CoordinatesError)
@@ -1,19 +1,55 @@
 import sys
-import xml.etree.cElementTree as ET
+import xml.etree.ElementTree as ET
 from enum import Enum
 from collections import namedtuple
 import numbers
 
+import numpy as np
 from tqdm import tqdm
 
 from tds_utils.aggregation.dataset_list import DatasetList, AggregatedGlobalAttr
 from tds_utils.aggregation.readers import NetcdfDatasetReader
 from tds_utils.aggregation.exceptions import AggregationError
+from tds_utils.xml_utils import (XML_PROLOG, element_to_file, start_tag,
+                                 end_tag, escape_attr)
 
 # Representation of a <variable> element in an NcML document. 'attrs' should
 # be a dictionary mapping name to value for desired child <attribute> elements
 NcMLVariable = namedtuple("NcMLVariable", ["name", "type", "shape", "attrs"])
 
+# Templates for the <netcdf> element for each file in an aggregation when
+# writing NcML. Attribute values should be escaped with escape_attr()
+_NETCDF_EL = '    <netcdf location="{location}"/>\n'
+_NETCDF_EL_COORDS = '    <netcdf location="{location}" coordValue="{coords}"/>\n'
+
+
+def coords_to_string(values):
+    """
+    Return a comma separated string of coordinate values for the 'coordValue'
+    attribute of a <netcdf> element
+    """
+    arr = np.asarray(values)
+    if arr.dtype == np.float64 or arr.dtype.kind in "iu":
+        # Python formats ints and floats in the same way as numpy does for
+        # integer types and float64, and converting to a list first avoids
+        # creating a numpy scalar for each value
+        return ",".join(map(str, arr.tolist()))
+    # Other types (e.g. float32) are formatted differently as Python floats,
+    # so let numpy do the conversion
+    return ",".join(arr.astype(str).tolist())
+
+
+def _netcdf_el_string(attrs):
+    """
+    Return the line for a <netcdf> element in an aggregation, given a dict of
+    its attributes
+    """
+    location = escape_attr(str(attrs["location"]))
+    if "coordValue" in attrs:
+        coords = escape_attr(str(attrs["coordValue"]))
+        return _NETCDF_EL_COORDS.format(location=location, coords=coords)
+    return _NETCDF_EL.format(location=location)
+
 
 class AggregationType(Enum):
     """
@@ -72,21 +108,22 @@ class BaseAggregationCreator(object):
         """
         Add a global attribute to the root <netcdf> element
         """
-        kwargs = {
+        attrib = {
             "name": attr,
             "value": str(value)
         }
         # Use numbers module as it works with numpy types too
         if isinstance(value, numbers.Integral):
-            kwargs["type"] = "int"
+            attrib["type"] = "int"
         elif isinstance(value, numbers.Real):
-            kwargs["type"] = "float"
+            attrib["type"] = "float"
 
-        element = ET.Element("attribute", **kwargs)
+        element = ET.Element("attribute", attrib)
         root.insert(0, element)
 
     def create_aggregation(self, file_list, cache=False, global_attrs=None,
-                           remove_attrs=None, attr_aggs=None):
+                           remove_attrs=None, attr_aggs=None, max_workers=None,
+                           coord_cache=None, coord_pattern=None, jobs=None):
         """
         Create an NcML aggregation for the filenames in `file_list` and return
         the root element as an instance of ET.Element.
@@ -102,6 +139,94 @@ class BaseAggregationCreator(object):
 
         `attr_aggs` is an optional list of AggregatedGlobalAttr objects for
         global attributes that should be calculated from individual files.
+
+        `max_workers` is an optional number of threads to use to read files
+        concurrently. By default files are read one at a time.
+
+        `coord_cache` is an optional CoordCache instance used to store
+        coordinate values so that files are not opened again on subsequent
+        runs.
+
+        `coord_pattern` is an optional regular expression (or list of regular
+        expressions) with a named group 'coord'. If given then the coordinate
+        value for each file is parsed from its filename instead of opening the
+        file when `cache` is True. If a list is given, the first pattern that
+        matches each filename is used. The value must be in the units of the
+        coordinate variable in the file; this is not checked.
+
+        `jobs` is an optional number of processes to use to read files, which
+        takes precedence over `max_workers`. The dataset reader class and any
+        `attr_aggs` callbacks must be picklable in this case.
+        """
+        root, aggregation, sub_el_attrs = self._create_root(
+            file_list, cache=cache, global_attrs=global_attrs,
+            remove_attrs=remove_attrs, attr_aggs=attr_aggs,
+            max_workers=max_workers, coord_cache=coord_cache,
+            coord_pattern=coord_pattern, jobs=jobs
+        )
+        for attrs in sub_el_attrs:
+            ET.SubElement(aggregation, "netcdf", attrs)
+
+        return self.process_root_element(root)
+
+    def write_aggregation(self, file_list, f, **kwargs):
+        """
+        Create an NcML aggregation as in create_aggregation() and write it to
+        the file object `f`. Keyword arguments are as for
+        create_aggregation().
+
+        If process_root_element() is not overridden, <netcdf> elements for
+        each file are written as they are created instead of being built up in
+        memory. Otherwise the whole aggregation is created first, since
+        process_root_element() may add to or change any part of it.
+        """
+        if (type(self).process_root_element is not
+                BaseAggregationCreator.process_root_element):
+            element_to_file(self.create_aggregation(file_list, **kwargs), f)
+            return
+
+        root, aggregation, sub_el_attrs = self._create_root(file_list, **kwargs)
+
+        f.write(XML_PROLOG + "\n")
+        f.write(start_tag(root) + "\n")
+        for child in root:
+            if child is not aggregation:
+                element_to_file(child, f, indentation=1)
+                f.write("\n")
+                continue
+
+            sub_el_attrs = iter(sub_el_attrs)
+            first = next(sub_el_attrs, None)
+            if first is None and not len(aggregation):
+                # Nothing to write inside the element, so use a self-closing
+                # tag as element_to_string() would
+                element_to_file(aggregation, f, indentation=1)
+                f.write("\n")
+                continue
+
+            f.write(start_tag(aggregation, indentation=1) + "\n")
+            # Format <netcdf> elements directly rather than creating an
+            # element for each one
+            if first is not None:
+                f.write(_netcdf_el_string(first))
+                for attrs in sub_el_attrs:
+                    f.write(_netcdf_el_string(attrs))
+            # Write any other children of <aggregation> after the <netcdf>
+            # elements
+            for sub_el in aggregation:
+                element_to_file(sub_el, f, indentation=2)
+                f.write("\n")
+            f.write(end_tag(aggregation, indentation=1) + "\n")
+        f.write(end_tag(root))
+
+    def _create_root(self, file_list, cache=False, global_attrs=None,
+                     remove_attrs=None, attr_aggs=None, max_workers=None,
+                     coord_cache=None, coord_pattern=None, jobs=None):
+        """
+        Create the root <netcdf> element of an aggregation without <netcdf>
+        elements for each file. Return (root, aggregation, sub_el_attrs),
+        where `aggregation` is the <aggregation> element and `sub_el_attrs`
+        is an iterable of dicts of attributes for each file.
         """
         root = ET.Element("netcdf", xmlns=self.ncml_xmlns)
         global_attrs = global_attrs or {}
@@ -117,33 +242,52 @@ class BaseAggregationCreator(object):
 
         extra_vars = self.extra_variables or []
         for var in extra_vars:
-            var_element = ET.SubElement(root, "variable", name=var.name,
-                                        shape=var.shape, type=var.type)
+            var_element = ET.SubElement(root, "variable", {
+                "name": var.name, "shape": var.shape, "type": var.type
+            })
             for name, value in var.attrs.items():
-                ET.SubElement(var_element, "attribute", name=name, value=value)
+                ET.SubElement(var_element, "attribute",
+                              {"name": name, "value": value})
 
         aggregation = ET.SubElement(root, "aggregation",
                                     dimName=self.dimension,
                                     type=self.aggregation_type.value)
 
-        # List of dicts containing attributes for <netcdf> sub-elements
+        # Iterable of dicts containing attributes for <netcdf> sub-elements
         sub_el_attrs = []
 
         if cache or attr_aggs:
             ds_list = DatasetList(self.dimension,
                                   ds_reader_cls=self.dataset_reader_cls,
-                                  attr_aggs=attr_aggs)
+                                  attr_aggs=attr_aggs,
+                                  coord_cache=coord_cache,
+                                  coord_pattern=coord_pattern,
+                                  cache_values=cache)
+            if jobs:
+                # The whole list is needed to split it between processes
+                file_list = list(file_list)
+            try:
+                total = len(file_list)
+            except TypeError:
+                total = None
+
+            # Read files in worker threads or processes but add them to the
+            # list in the main thread, in the original order
+            results = ds_list.read_many(file_list, max_workers=max_workers,
+                                        jobs=jobs)
             # tqdm shows a progress bar
-            for filename in tqdm(file_list, ncols=80):
-                ds_list.add(filename)
+            for result in tqdm(results, total=total, ncols=80):
+                if result:
+                    ds_list.add_values(*result)
 
             if not ds_list:
                 raise AggregationError("No aggregation could be created")
 
+            # Files are sorted (and checked for overlaps) here
             for filename, values in ds_list.datasets():
                 attrs = {"location": filename}
-                if not ds_list.multiple_units:
-                    attrs["coordValue"] = ",".join(map(str, values))
+                if values is not None:
+                    attrs["coordValue"] = coords_to_string(values)
                 sub_el_attrs.append(attrs)
 
             if ds_list.multiple_units and self.dimension == "time":
@@ -159,12 +303,11 @@ class BaseAggregationCreator(object):
                 self.add_global_attr(root, attr_agg.attr, value)
 
         else:
-            sub_el_attrs = [{"location": filename} for filename in file_list]
+            # Use a generator so that file_list is only iterated over when the
+            # elements are created or written
+            sub_el_attrs = ({"location": filename} for filename in file_list)
 
-        for attrs in sub_el_attrs:
-            ET.SubElement(aggregation, "netcdf", **attrs)
-
-        return self.process_root_element(root)
+        return root, aggregation, sub_el_attrs
 
 
 class AggregationCreator(BaseAggregationCreator):
@@ -0,0 +1,107 @@
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+
+class CoordCache(object):
+    """
+    Persistent cache of coordinate values read from datasets, stored in an
+    SQLite database.
+
+    Entries are keyed on the path of the dataset, the dimension and the reader
+    class, and are only used if the modification time and size of the file
+    have not changed since the values were stored.
+
+    Use the path IN_MEMORY to keep the cache in memory instead, e.g. to reuse
+    coordinate values when creating several aggregations from overlapping
+    file lists in one program. An in-memory cache is not shared with other
+    processes, so is not populated when reading files with `jobs`.
+    """
+    DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".cache", "tds-utils",
+                                "coords.sqlite")
+    IN_MEMORY = ":memory:"
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        # The connection is shared between threads, so serialise access to it
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        # WAL mode allows multiple processes to use the cache at once
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS coords ("
+            "path TEXT, dimension TEXT, reader TEXT, mtime INTEGER, "
+            "size INTEGER, units TEXT, dtype TEXT, coord_values BLOB, "
+            "PRIMARY KEY (path, dimension, reader))"
+        )
+        self.conn.commit()
+
+    @staticmethod
+    def _key(filename, dimension, reader_cls):
+        """
+        Return (key, mtime, size) for a dataset, or None if the file cannot be
+        stat'd
+        """
+        try:
+            stat = os.stat(filename)
+        except (OSError, TypeError, ValueError):
+            return None
+        path = os.path.abspath(filename)
+        reader = "{}:{}".format(reader_cls.__module__, reader_cls.__qualname__)
+        return (path, dimension, reader), stat.st_mtime_ns, stat.st_size
+
+    def get(self, filename, dimension, reader_cls):
+        """
+        Return (units, values) for a dataset if present in the cache and the
+        file has not changed, or None otherwise
+        """
+        key = self._key(filename, dimension, reader_cls)
+        if key is None:
+            return None
+        key, mtime, size = key
+
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT mtime, size, units, dtype, coord_values FROM coords "
+                "WHERE path = ? AND dimension = ? AND reader = ?", key
+            ).fetchone()
+
+        if row is None or row[0] != mtime or row[1] != size:
+            return None
+        units, dtype, blob = row[2:]
+        return units, np.frombuffer(blob, dtype=dtype)
+
+    def set(self, filename, dimension, reader_cls, units, values):
+        """
+        Store the units and values read from a dataset
+        """
+        key = self._key(filename, dimension, reader_cls)
+        if key is None:
+            return
+        key, mtime, size = key
+        arr = np.asarray(values)
+
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO coords VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                key + (mtime, size, units, arr.dtype.str, arr.tobytes())
+            )
+            self.conn.commit()
+
+    def __getstate__(self):
+        # Connections cannot be pickled, so reconnect when unpickled (e.g. when
+        # reading files in another process)
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def close(self):
+        self.conn.close()
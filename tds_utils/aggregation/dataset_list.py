@@ -1,16 +1,39 @@
 import sys
-import bisect
-from collections import namedtuple
+import re
+import threading
+import contextlib
+import functools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy as np
 
 from tds_utils.aggregation.exceptions import (CoordinatesError,
                                               OverlappingUnitsError)
 
 
+# Placeholder for the units of the list before any values have been added
+_NO_UNITS = object()
+
+# Lock held while reading datasets with a reader class that is not thread-safe
+_READER_LOCK = threading.Lock()
+
+
+def _reader_lock(reader):
+    """
+    Return a context manager to hold while opening and reading from `reader`
+    """
+    if reader.thread_safe:
+        return contextlib.nullcontext()
+    return _READER_LOCK
+
+
 class AggregatedGlobalAttr:
     """
     Class to represent a global variable whose value should be calculated using
     values of the attribute in each dataset
     """
+    __slots__ = ("attr", "callback", "values")
+
     def __init__(self, attr, callback):
         """
         `attr` is the attribute name, and `callback` is a function that takes
@@ -32,101 +55,311 @@ class AggregatedGlobalAttr:
         return self.callback(self.values)
 
 
-class Interval(object):
-    """
-    Class representing an interval of floats that can be ordered based its
-    lower bound
-    """
-    def __init__(self, values):
-        self.values = values
-        self.lower = values[0]
-        self.upper = values[-1]
-
-    def __lt__(self, x):
-        return self.lower < x.lower
-
-
-class DatasetList(list):
+class DatasetList(object):
     """
     A list of datasets that can be sorted by their coordinate values
     """
+    __slots__ = ("dimension", "ds_reader_cls", "attr_aggs", "cache_values",
+                 "coord_cache", "coord_patterns", "_first_units",
+                 "multiple_units", "_last_pattern", "_sorted", "_filenames",
+                 "_values", "_lowers", "_uppers")
 
-    def __init__(self, dimension, ds_reader_cls, attr_aggs=None):
+    def __init__(self, dimension, ds_reader_cls, attr_aggs=None,
+                 coord_cache=None, coord_pattern=None, cache_values=True):
         self.dimension = dimension
         self.ds_reader_cls = ds_reader_cls
         self.attr_aggs = attr_aggs or []
+        # Whether to keep the coordinate values for each file. If False, only
+        # the bounds needed to sort the list are kept and datasets() yields
+        # None for the values
+        self.cache_values = cache_values
+        # Optional CoordCache instance to avoid opening files whose
+        # coordinate values have been read before
+        self.coord_cache = coord_cache
+
+        # Optional regex (or list of regexes) with a named group 'coord' to
+        # extract a single (numeric) coordinate value from each filename
+        # instead of opening the file
+        self.coord_patterns = None
+        if coord_pattern is not None:
+            if isinstance(coord_pattern, (str, re.Pattern)):
+                coord_pattern = [coord_pattern]
+            self.coord_patterns = [re.compile(p) for p in coord_pattern]
+            for pattern in self.coord_patterns:
+                if "coord" not in pattern.groupindex:
+                    raise ValueError("Filename pattern '{}' must contain a "
+                                     "named group 'coord'"
+                                     .format(pattern.pattern))
+        # Index of the pattern that matched the previous filename. Files
+        # following the same naming convention tend to be listed together, so
+        # this pattern is tried first
+        self._last_pattern = 0
 
-        # Keep track of units seen in files added to the list, so that we can
-        # tell if all files have the same units or not
-        self.found_units = set([])
+        # Keep track of the units of the first file added to the list, so
+        # that we can tell if all files have the same units or not
+        self._first_units = _NO_UNITS
         self.multiple_units = False
 
-        super().__init__(self)
+        # Parallel lists of filenames, coordinate values (None if not stored)
+        # and the bounds of the coordinate values. Bounds are converted to
+        # numpy arrays to sort and check for overlaps in finalize()
+        self._sorted = True
+        self._filenames = []
+        self._values = []
+        self._lowers = []
+        self._uppers = []
+
+    def __len__(self):
+        return len(self._filenames)
+
+    def __getstate__(self):
+        state = {name: getattr(self, name) for name in DatasetList.__slots__}
+        # Include attributes of sub-classes that do not define __slots__
+        state.update(getattr(self, "__dict__", {}))
+        # Entries are not needed to read files in another process
+        state.update(_sorted=True, _filenames=[], _values=[], _lowers=[],
+                     _uppers=[])
+        # The placeholder would not be the same object once unpickled
+        del state["_first_units"]
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+        self._first_units = _NO_UNITS
 
     def add(self, filename):
         """
         Add a file (and its coordinate values) to the list
         """
+        result = self.read(filename)
+        if result:
+            self.add_values(*result)
+
+    def add_many(self, filenames, max_workers=None, jobs=None):
+        """
+        Add multiple files to the list, reading them concurrently -- see
+        read_many()
+        """
+        for result in self.read_many(filenames, max_workers=max_workers,
+                                     jobs=jobs):
+            if result:
+                self.add_values(*result)
+
+    def read_many(self, filenames, max_workers=None, jobs=None):
+        """
+        Return a generator yielding the result of read() for each file in
+        `filenames`, in order.
+
+        Files are read in `max_workers` threads, or `jobs` processes if given,
+        or one at a time in the current thread by default. The dataset reader
+        class and any `attr_aggs` callbacks must be picklable if `jobs` is
+        given.
+        """
+        if jobs:
+            # Send files to each process in chunks to reduce the overhead of
+            # pickling the list and results
+            filenames = list(filenames)
+            chunksize = max(1, len(filenames) // (4 * jobs))
+            executor = ProcessPoolExecutor(max_workers=jobs)
+            results = executor.map(self.read, filenames, chunksize=chunksize)
+        elif max_workers:
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+            # Other threads may be waiting for the reader lock, so start I/O
+            # for each file while they wait
+            read = functools.partial(self.read, prefetch=True)
+            results = executor.map(read, filenames)
+        else:
+            yield from map(self.read, filenames)
+            return
+
+        with executor:
+            yield from results
+
+    def read(self, filename, prefetch=False):
+        """
+        Open a file and return (filename, units, values, attr_values), where
+        `attr_values` is a dict mapping attribute name to value for the
+        attributes in `attr_aggs`.
+
+        If the coordinate values could not be read, print a warning and return
+        None. If the values are not needed because multiple units have already
+        been found (and there are no attributes to read), the file is not
+        opened and `units` and `values` are None.
+
+        This does not add to the list, so may be called from multiple threads
+        at once; the result should be passed to add_values(). The only state
+        it updates is the index of the last matching filename pattern, which
+        is just a hint for coords_from_filename(), so a race between threads
+        only costs an extra pattern match.
+
+        If `prefetch` is True and the dataset reader is not thread-safe, call
+        the reader's prefetch() method before waiting for the lock. This is
+        only useful when other threads may be holding the lock.
+        """
         # If already know there are multiple units, sort order does not matter
         # so do not bother to open file (unless need to read attributes)
         if not self.attr_aggs and self.multiple_units:
-            self.append((None, filename))
-            return
+            return filename, None, None, {}
 
-        with self.ds_reader_cls(filename) as ds:
+        coords = None
+        if self.coord_patterns is not None:
             try:
-                units, values = ds.get_coord_values(self.dimension)
+                coords = self.coords_from_filename(filename)
             except CoordinatesError as ex:
                 print("WARNING: {}".format(ex), file=sys.stderr)
-                return
-
-            # Update attribute aggregation values
-            for attr_agg in self.attr_aggs:
-                try:
-                    attr_value = ds.get_attribute(attr_agg.attr)
-                except AttributeError:
-                    print("WARNING: Attribute '{}' not found in '{}'"
-                          .format(attr_agg.attr, filename),
-                          file=sys.stderr)
+                return None
+            # Only need to open the file to read attributes
+            if not self.attr_aggs:
+                units, values = coords
+                return filename, units, values, {}
+
+        # Attributes are not cached, so only use the cache if they are not
+        # required
+        use_cache = (self.coord_cache is not None and not self.attr_aggs and
+                     coords is None)
+        if use_cache:
+            cached = self.coord_cache.get(filename, self.dimension,
+                                          self.ds_reader_cls)
+            if cached is not None:
+                units, values = cached
+                return filename, units, values, {}
+
+        attr_values = {}
+        reader = self.ds_reader_cls(filename)
+        if prefetch and not reader.thread_safe:
+            reader.prefetch()
+        with _reader_lock(reader):
+            with reader as ds:
+                if coords is None:
+                    try:
+                        coords = ds.get_coord_values(self.dimension)
+                    except CoordinatesError as ex:
+                        print("WARNING: {}".format(ex), file=sys.stderr)
+                        return None
+                units, values = coords
+
+                if self.attr_aggs:
+                    attrs = [attr_agg.attr for attr_agg in self.attr_aggs]
+                    attr_values = ds.get_attributes(attrs)
+                    for attr in attrs:
+                        if attr not in attr_values:
+                            print("WARNING: Attribute '{}' not found in '{}'"
+                                  .format(attr, filename), file=sys.stderr)
+
+        if use_cache:
+            self.coord_cache.set(filename, self.dimension, self.ds_reader_cls,
+                                 units, values)
+        return filename, units, values, attr_values
+
+    def coords_from_filename(self, filename):
+        """
+        Return (units, values) for a file by matching the patterns in
+        `coord_patterns` against its filename; the first pattern that matches
+        is used. The value is parsed as an integer if possible, or a float
+        otherwise. Units are always None.
+
+        Raise CoordinatesError if no pattern matches.
+        """
+        last = self._last_pattern
+        match = self.coord_patterns[last].search(filename)
+        if not match:
+            for i, pattern in enumerate(self.coord_patterns):
+                if i == last:
                     continue
-                attr_agg.add_value(attr_value)
+                match = pattern.search(filename)
+                if match:
+                    self._last_pattern = i
+                    break
+            else:
+                raise CoordinatesError(
+                    "Filename '{}' does not match any pattern in {}".format(
+                        filename, [p.pattern for p in self.coord_patterns]
+                    )
+                )
+        value_str = match.group("coord")
+        try:
+            value = int(value_str)
+        except ValueError:
+            try:
+                value = float(value_str)
+            except ValueError:
+                raise CoordinatesError("Invalid coordinate value '{}' in "
+                                       "filename '{}'".format(value_str, filename))
+        return None, [value]
+
+    def add_values(self, filename, units, values, attr_values):
+        """
+        Add a file to the list given the values returned by read()
+        """
+        # Update attribute aggregation values
+        for attr_agg in self.attr_aggs:
+            if attr_agg.attr in attr_values:
+                attr_agg.add_value(attr_values[attr_agg.attr])
+
+        if values is not None and not self.multiple_units:
+            # Check if these units are the same as the first file's. This
+            # avoids hashing the units string for every file, and interning
+            # lets units strings that are already interned compare by identity
+            if self._first_units is _NO_UNITS:
+                if isinstance(units, str):
+                    units = sys.intern(units)
+                self._first_units = units
+            elif units != self._first_units:
+                self.multiple_units = True
+                # Values for files already added are no longer needed
+                self._values = [None] * len(self._filenames)
+                self._lowers = []
+                self._uppers = []
+
+        if values is None or self.multiple_units:
+            self._filenames.append(filename)
+            self._values.append(None)
+            return
 
-        # Check if we have seen these units before
-        self.found_units.add(units)
-        if len(self.found_units) > 1:
-            self.multiple_units = True
-            self.add(filename)
+        # The list is sorted once all files have been added -- see finalize()
+        self._sorted = False
+        self._filenames.append(filename)
+        self._values.append(values if self.cache_values else None)
+        self._lowers.append(values[0])
+        self._uppers.append(values[-1])
+
+    def finalize(self):
+        """
+        Sort the list by coordinate values once all files have been added, and
+        check that no two files have overlapping values. This is called by
+        datasets() if required, so does not usually need to be called
+        directly.
+
+        Raise OverlappingUnitsError if an overlap is found.
+        """
+        # If there are multiple units, sort order does not matter and values
+        # cannot be compared
+        if self._sorted or self.multiple_units:
             return
 
-        interval = Interval(values)
-        # Sort by interval but keep track of filename too
-        key = (interval, filename)
-        # Get index to insert at to preserve sort order
-        idx = bisect.bisect(self, key)
-        self.insert(idx, key)
-
-        # Check that this interval does not overlap with the previous or
-        # next ones
-        before = None
-        after = None
-        if idx > 0:
-            before = self[idx - 1][0]
-        if idx < len(self) - 1:
-            after = self[idx + 1][0]
-
-        if ((before and interval.lower <= before.upper) or
-                (after and interval.upper >= after.lower)):
+        order = np.argsort(self._lowers, kind="stable")
+        lowers = np.asarray(self._lowers)[order]
+        uppers = np.asarray(self._uppers)[order]
+        # Each interval must start after the previous one ends
+        if np.any(lowers[1:] <= uppers[:-1]):
             raise OverlappingUnitsError("File list has overlapping coordinate "
                                         "values")
 
+        self._filenames = [self._filenames[i] for i in order]
+        self._values = [self._values[i] for i in order]
+        self._lowers = lowers.tolist()
+        self._uppers = uppers.tolist()
+        self._sorted = True
+
     def datasets(self):
         """
         Return a generator yielding (filename, coordinate_values), or
-        (filename, None) if multiple units were found and values were not
-        stored
+        (filename, None) if multiple units were found or `cache_values` is
+        False and values were not stored. Datasets are yielded in order of
+        their coordinate values.
+
+        Raise OverlappingUnitsError if any files have overlapping values.
         """
-        for interval, filename in self:
-            if interval:
-                yield filename, interval.values
-            else:
-                yield filename, None
+        self.finalize()
+        yield from zip(self._filenames, self._values)
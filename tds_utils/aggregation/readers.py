@@ -1,4 +1,6 @@
-from netCDF4 import Dataset
+import os
+
+import numpy as np
 
 from tds_utils.aggregation.exceptions import CoordinatesError
 
@@ -8,10 +10,24 @@ class BaseDatasetReader(object):
     Class to encapsulate opening a dataset and reading coordinate values from
     it
     """
+    # Whether multiple instances may be used from different threads at the
+    # same time. If False, reads are serialised when aggregating with
+    # multiple threads
+    thread_safe = False
 
     def __init__(self, filename):
         self.filename = filename
 
+    def prefetch(self):
+        """
+        Hint that the dataset will be opened soon. When files are read in
+        multiple threads, this is called before the lock for non-thread-safe
+        readers is acquired, so may be used to start I/O while other files are
+        being read.
+
+        By default do nothing.
+        """
+
     def __enter__(self):
         """
         Open the file or perform other setup tasks
@@ -27,8 +43,8 @@ class BaseDatasetReader(object):
     def get_coord_values(self, dimension):
         """
         Return (units, values) where `units` are the units for the given
-        dimension in the dataset, and `values` is a list of coordinate values
-        sorted in ascending order.
+        dimension in the dataset, and `values` is a list or numpy array of
+        coordinate values sorted in ascending order.
 
         This method should raise CoordinatesError on error.
         """
@@ -40,13 +56,60 @@ class BaseDatasetReader(object):
         """
         raise NotImplementedError
 
+    def get_attributes(self, attrs):
+        """
+        Return a dict mapping name to value for the global attributes in
+        `attrs` that are present in the dataset.
+
+        By default call get_attribute() for each attribute -- override in
+        child classes if multiple attributes can be read more efficiently.
+        """
+        values = {}
+        for attr in attrs:
+            try:
+                values[attr] = self.get_attribute(attr)
+            except AttributeError:
+                pass
+        return values
+
 
 class NetcdfDatasetReader(BaseDatasetReader):
     """
     Dataset reader that reads NetCDF files
     """
+    # The netCDF-C library is not thread-safe
+    thread_safe = False
+
+    # Number of bytes at the start of the file to prefetch. This covers the
+    # header/superblock that is read when the file is opened
+    prefetch_size = 64 * 1024
+
+    def prefetch(self):
+        # Ask the OS to read the start of the file into the page cache, so
+        # that opening it does not block on a cold disk or network filesystem.
+        # posix_fadvise is not available on all platforms
+        if not hasattr(os, "posix_fadvise"):
+            return
+        try:
+            fd = os.open(self.filename, os.O_RDONLY)
+        except (OSError, TypeError, ValueError):
+            return
+        try:
+            os.posix_fadvise(fd, 0, self.prefetch_size,
+                             os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
     def __enter__(self):
+        # Import here since netCDF4 is slow to import, and is not needed
+        # unless files are opened
+        from netCDF4 import Dataset
         self.ds = Dataset(self.filename)
+        # Coordinate values should not contain fill values, so skip the cost
+        # of creating masked arrays
+        self.ds.set_auto_mask(False)
         return self
 
     def __exit__(self, *args, **kwargs):
@@ -66,12 +129,23 @@ class NetcdfDatasetReader(BaseDatasetReader):
                 "in file '{}'" .format(var.shape, self.filename)
             )
 
-        values = sorted(var)
-        try:
-            units = var.units
-        except AttributeError:
-            units = None
+        # Read all values at once and sort in numpy rather than iterating over
+        # the variable in Python. Coordinates are usually monotonic, in which
+        # case the sort can be skipped
+        values = var[:]
+        if not np.all(values[1:] >= values[:-1]):
+            if np.all(values[1:] <= values[:-1]):
+                values = values[::-1]
+            else:
+                values = np.sort(values)
+        units = var.getncattr("units") if "units" in var.ncattrs() else None
         return units, values
 
     def get_attribute(self, attr):
         return getattr(self.ds, attr)
+
+    def get_attributes(self, attrs):
+        # Read all global attributes at once rather than looking each one up
+        # separately
+        all_attrs = self.ds.__dict__
+        return {attr: all_attrs[attr] for attr in attrs if attr in all_attrs}
@@ -2,13 +2,12 @@
 Read filenames of datasets from standard input and print an NcML aggregation to
 standard output.
 """
-import os
+import re
 import sys
 import argparse
 from importlib import import_module
 
-from tds_utils.aggregation import AggregationCreator
-from tds_utils.xml_utils import element_to_string
+from tds_utils.aggregation import AggregationCreator, CoordCache
 
 
 def python_class(string):
@@ -25,6 +24,21 @@ def python_class(string):
     return getattr(module, cls_name)
 
 
+def filename_pattern(string):
+    """
+    Compile and return a regex containing a named group 'coord'
+    """
+    try:
+        pattern = re.compile(string)
+    except re.error as ex:
+        raise argparse.ArgumentTypeError("Invalid regex: {}".format(ex))
+    if "coord" not in pattern.groupindex:
+        raise argparse.ArgumentTypeError(
+            "Pattern must contain a named group 'coord'"
+        )
+    return pattern
+
+
 def main():
     parser = argparse.ArgumentParser(
         description=__doc__,
@@ -68,8 +82,50 @@ def main():
              "given multiple times"
     )
 
+    parser.add_argument(
+        "--coord-cache",
+        nargs="?",
+        const=CoordCache.DEFAULT_PATH,
+        metavar="PATH",
+        help="Store coordinate values read with --cache in an SQLite database "
+             "at PATH, so that unchanged files are not opened again on "
+             "subsequent runs [default path: {}]".format(CoordCache.DEFAULT_PATH)
+    )
+
+    parser.add_argument(
+        "--filename-pattern",
+        type=filename_pattern,
+        action="append",
+        help="Regular expression with a named group 'coord' to extract the "
+             "coordinate value for each file from its filename with --cache, "
+             "instead of opening the file. The value must be in the units of "
+             "the coordinate variable in the files (these are not checked), "
+             "e.g. '_day(?P<coord>\\d+)\\.nc$' for a file 'tas_day17897.nc' "
+             "with units 'days since 1970-01-01'. Can be given multiple "
+             "times, in which case the first pattern that matches each "
+             "filename is used"
+    )
+
+    parser.add_argument(
+        "-w", "--workers",
+        type=int,
+        help="Number of threads to use to read files with --cache. NetCDF "
+             "files are still read one at a time since the NetCDF library "
+             "is not thread-safe; threads only start I/O for the start of "
+             "each file while waiting. Use --jobs to read files in parallel "
+             "[default: read files one at a time]"
+    )
+
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        help="Number of processes to use to read files with --cache "
+             "[default: read files in the main process]"
+    )
+
     args = parser.parse_args(sys.argv[1:])
-    path_list = [line for line in sys.stdin.read().split(os.linesep) if line]
+    # Read lines lazily rather than reading all of stdin at once
+    path_list = (line.rstrip("\r\n") for line in sys.stdin if line.strip())
     creator = args.agg_creator_cls(args.dimension)
 
     # Build global attributes dict
@@ -83,7 +139,14 @@ def main():
                          "form '<attr>=<value>'".format(attr_string))
         global_attrs[attr] = value
 
-    ncml_el = creator.create_aggregation(path_list, cache=args.cache,
-                                         global_attrs=global_attrs,
-                                         remove_attrs=args.remove_attr)
-    print(element_to_string(ncml_el))
+    coord_cache = None
+    if args.coord_cache:
+        coord_cache = CoordCache(args.coord_cache)
+
+    creator.write_aggregation(path_list, sys.stdout, cache=args.cache,
+                              global_attrs=global_attrs,
+                              remove_attrs=args.remove_attr,
+                              coord_cache=coord_cache,
+                              coord_pattern=args.filename_pattern,
+                              max_workers=args.workers, jobs=args.jobs)
+    print()
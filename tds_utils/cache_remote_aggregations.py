@@ -22,8 +22,19 @@ import argparse
 
 import requests
 
+# orjson parses large documents much faster than the standard library, so use
+# it if installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 class AggregationCacher(object):
+    # Suffixes for OPeNDAP and WMS endpoint URLs
+    opendap_suffix = ".dds"
+    wms_suffix = "?service=WMS&version=1.3.0&request=GetCapabilities"
+
     def __init__(self, input_json, base_thredds_url, verbose=False):
         if base_thredds_url.endswith("/"):
             base_thredds_url = base_thredds_url[:-1]
@@ -31,23 +42,22 @@ class AggregationCacher(object):
         self.base_thredds_url = base_thredds_url
         self.verbose = verbose
 
-        with open(input_json) as f:
-            self.json_doc = json.load(f)
+        # URLs for each dataset only differ by ID, so build the start of each
+        # URL once
+        self.opendap_prefix = base_thredds_url + "/dodsC/"
+        self.wms_prefix = base_thredds_url + "/wms/"
+
+        with open(input_json, "rb") as f:
+            data = f.read()
+        self.json_doc = orjson.loads(data) if orjson else json.loads(data)
 
     def aggregation_url(self, ds_id, wms=False):
         """
         Return the URL to an OPenDAP or WMS endpoint for a dataset
         """
         if wms:
-            service = "wms"
-            suffix = "?service=WMS&version=1.3.0&request=GetCapabilities"
-        else:
-            service = "dodsC"
-            suffix = ".dds"
-
-        url = "{base}/{service}/{ds_id}{suffix}"
-        return url.format(base=self.base_thredds_url, service=service,
-                          ds_id=ds_id, suffix=suffix)
+            return self.wms_prefix + ds_id + self.wms_suffix
+        return self.opendap_prefix + ds_id + self.opendap_suffix
 
     def get_all_urls(self):
         """
@@ -56,11 +66,7 @@ class AggregationCacher(object):
         """
         for ds_id, ds_info in self.json_doc.items():
             if ds_info["generate_aggregation"]:
-                try:
-                    wms = ds_info["include_in_wms"]
-                except KeyError:
-                    wms = False
-
+                wms = ds_info.get("include_in_wms", False)
                 yield self.aggregation_url(ds_id, wms=wms)
 
     def cache_all(self):
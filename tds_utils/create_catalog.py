@@ -5,11 +5,10 @@ catalogs or root-level catalogs with links to other catalogs.
 import sys
 import os
 import argparse
+import functools
 from enum import Enum
 from collections import namedtuple as nt
-from xml.etree import cElementTree as ET
-
-from jinja2 import Environment, PackageLoader
+from xml.etree import ElementTree as ET
 
 
 # Classes corresponding to various elements that make up the catalog
@@ -36,17 +35,33 @@ class AvailableServices(Enum):
     OPENDAP = ThreddsService(name="opendap", type="OpenDAP", base="dodsC")
 
 
+# Combinations of services used in dataset catalogs. These are tuples so that
+# services are always listed in the same order, and are quick to iterate over
+# for each dataset
+HTTP_SERVICES = (AvailableServices.HTTP.value,)
+OPENDAP_SERVICES = (AvailableServices.OPENDAP.value,)
+HTTP_AND_OPENDAP_SERVICES = HTTP_SERVICES + OPENDAP_SERVICES
+
+
 def get_catalog_name(filename):
     """
     Parse a catalog and return its name
     """
-    tree = ET.ElementTree()
+    # Parse the whole document so that malformed catalogs are rejected, but
+    # only the root element is needed so discard the others once parsed
+    root = None
     try:
-        tree.parse(filename)
+        with open(filename, "rb") as f:
+            for event, el in ET.iterparse(f, events=("start", "end")):
+                if root is None:
+                    root = el
+                elif event == "end" and el is not root:
+                    el.clear()
     except ET.ParseError:
+        root = None
+    if root is None:
         raise ValueError("File '{}' is not a valid XML document"
                          .format(filename))
-    root = tree.getroot()
 
     try:
         return root.attrib["name"]
@@ -58,12 +73,27 @@ def get_catalog_name(filename):
         return basename
 
 
+@functools.lru_cache(maxsize=None)
+def get_environment():
+    """
+    Return the Jinja2 environment used to render catalogs. This is shared
+    between CatalogBuilder instances so that templates are only loaded and
+    compiled once
+    """
+    # Import here so that jinja2 is only imported when a catalog is rendered
+    from jinja2 import Environment, PackageLoader
+
+    # The environment caches compiled templates. Templates are part of the
+    # package so do not change while running -- auto_reload=False skips
+    # checking them for changes each time they are used
+    return Environment(loader=PackageLoader("tds_utils", "templates"),
+                       trim_blocks=True, lstrip_blocks=True, auto_reload=False)
+
+
 class CatalogBuilder(object):
 
     def __init__(self):
-        self.env = Environment(loader=PackageLoader("tds_utils", "templates"))
-        self.env.trim_blocks = True
-        self.env.lstrip_blocks = True
+        self.env = get_environment()
 
     def render(self, template_name, **kwargs):
         """
@@ -72,9 +102,16 @@ class CatalogBuilder(object):
         template = self.env.get_template(template_name)
         return template.render(**kwargs)
 
-    def create_dataset(self, filename, ds_root, file_services):
+    def create_dataset(self, filename, ds_root, file_services, cwd=None):
+        """
+        Return a ThreddsDataset for a file. `cwd` is the directory relative
+        paths are resolved against, which defaults to the current directory
+        """
         this_id = os.path.basename(filename)
-        url_path = ds_root.path + os.path.abspath(filename)
+        # Equivalent to os.path.abspath(), but without calling os.getcwd() for
+        # every file when `cwd` is given
+        cwd = cwd or os.getcwd()
+        url_path = ds_root.path + os.path.normpath(os.path.join(cwd, filename))
         a_meths = [AccessMethod(s, url_path, "NetCDF-4") for s in file_services]
         return ThreddsDataset(name=this_id, id=this_id, access_methods=a_meths)
 
@@ -83,21 +120,20 @@ class CatalogBuilder(object):
         Build a THREDDS catalog and return the XML as a string
         """
         # Work out which services are required
-        file_services = set([AvailableServices.HTTP.value])
-        if opendap:
-            file_services.add(AvailableServices.OPENDAP.value)
-        aggregation_services = set([AvailableServices.OPENDAP.value])
-        all_services = file_services.copy()
+        file_services = HTTP_AND_OPENDAP_SERVICES if opendap else HTTP_SERVICES
+        aggregation_services = OPENDAP_SERVICES
+        all_services = file_services
         if ncml_path:
-            all_services.add(AvailableServices.OPENDAP.value)
+            all_services = HTTP_AND_OPENDAP_SERVICES
 
         # An absolute path as urlPath does not work, so need to use a
         # datasetRoot
         ds_root = DatasetRoot(path="{}_root".format(ds_id), location="/")
 
         datasets = []
+        cwd = os.getcwd()
         for filename in filenames:
-            ds = self.create_dataset(filename, ds_root, file_services)
+            ds = self.create_dataset(filename, ds_root, file_services, cwd=cwd)
             datasets.append(ds)
 
         aggregation = None
@@ -124,10 +160,15 @@ class CatalogBuilder(object):
         XML as a string
         """
         catalogs = []
+        cwd = os.getcwd()
+        root_dir = os.path.normpath(os.path.join(cwd, root_dir))
         for path in cat_paths:
             cat_name = get_catalog_name(path)
-            # href must be relative to the root catalog itself
-            href = os.path.relpath(os.path.abspath(path), start=root_dir)
+            # href must be relative to the root catalog itself. Resolve paths
+            # against `cwd` rather than using os.path.abspath() and relpath()
+            # so that os.getcwd() is only called once
+            path = os.path.normpath(os.path.join(cwd, path))
+            href = os.path.relpath(path, start=root_dir)
             catalogs.append(CatalogRef(name=cat_name, title=cat_name,
                                        href=href))
         return self.render("root_catalog.xml", name=name, catalogs=catalogs)
@@ -198,10 +239,11 @@ def main():
 
     builder = CatalogBuilder()
     if args.type == "dataset":
-        filenames = [line.strip() for line in args.files.readlines() if line]
+        # Read lines lazily rather than reading the whole file at once
+        filenames = (line.strip() for line in args.files if line.strip())
         print(builder.dataset_catalog(filenames, args.ds_id,
                                       opendap=args.opendap,
                                       ncml_path=args.ncml))
     elif args.type == "root":
-        paths = [line.strip() for line in args.catalogs.readlines() if line]
+        paths = (line.strip() for line in args.catalogs if line.strip())
         print(builder.root_catalog(paths, args.root_dir))
@@ -6,16 +6,17 @@ import sys
 import re
 import os
 import argparse
-import xml.etree.cElementTree as ET
+import xml.etree.ElementTree as ET
 
 from tds_utils.xml_utils import find_by_tagname
 
 
-def find_ncml_references(catalog_filename):
+def find_ncml_references(catalog_file):
     """
-    Find <netcdf> elements and extract paths from their 'location' attributes
+    Find <netcdf> elements and extract paths from their 'location' attributes.
+    `catalog_file` may be a filename or a binary file object.
     """
-    for el in find_by_tagname(catalog_filename, "netcdf"):
+    for el in find_by_tagname(catalog_file, "netcdf", clear=True):
         yield el.attrib["location"]
 
 
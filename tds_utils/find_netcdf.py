@@ -5,7 +5,7 @@ Known dataset roots for specific projects are replaced with their paths on disk.
 """
 import sys
 import argparse
-import xml.etree.cElementTree as ET
+import xml.etree.ElementTree as ET
 
 from tds_utils.xml_utils import find_by_tagname
 
@@ -17,8 +17,8 @@ DATASET_ROOTS = {
 }
 
 
-def find_netcdf_references(catalog_filename, dataset_roots={}):
-    for el in find_by_tagname(catalog_filename, "dataset"):
+def find_netcdf_references(catalog_file, dataset_roots={}):
+    for el in find_by_tagname(catalog_file, "dataset", clear=True):
         if "urlPath" in el.attrib:
             path = el.get("urlPath")
 
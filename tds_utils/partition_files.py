@@ -19,6 +19,9 @@ def partition_files(file_list):
     with 'x') to lists of filenames.
     """
     d = {}
+    # Cache of keys for directories already seen, since typically many files
+    # are in the same directory
+    keys = {}
 
     for path in file_list:
         # Create a key for each file by replacing date parts of path with 'x'.
@@ -26,15 +29,20 @@ def partition_files(file_list):
 
         # Discard basename (it is assumed that all files in the same directory
         # can be aggregated)
-        components = path.split(os.path.sep)[:-1]
-        for i, comp in enumerate(components):
-            # Another assumption is that all dates take up a whole component
-            # of the hierarchy, and conversely that any components consisting
-            # of only digits is a date.
-            if comp.isnumeric():
-                components[i] = "x" * len(comp)
-
-        replaced_path = os.path.sep.join(components)
+        dirname = path.rpartition(os.path.sep)[0]
+        try:
+            replaced_path = keys[dirname]
+        except KeyError:
+            components = dirname.split(os.path.sep)
+            for i, comp in enumerate(components):
+                # Another assumption is that all dates take up a whole
+                # component of the hierarchy, and conversely that any
+                # components consisting of only digits is a date.
+                if comp.isnumeric():
+                    components[i] = "x" * len(comp)
+            replaced_path = os.path.sep.join(components)
+            keys[dirname] = replaced_path
+
         if replaced_path not in d:
             d[replaced_path] = []
         d[replaced_path].append(path)
@@ -51,6 +59,7 @@ def main():
     )
     _args = parser.parse_args(sys.argv[1:])
 
-    path_list = [line for line in sys.stdin.read().split(os.linesep) if line]
+    # Read lines lazily rather than reading all of stdin at once
+    path_list = (line.rstrip("\r\n") for line in sys.stdin if line.strip())
     groups = partition_files(path_list)
     print(os.linesep.join(groups.keys()))
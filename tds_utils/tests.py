@@ -1,8 +1,8 @@
 import os
-import xml.etree.cElementTree as ET
+import sys
+import io
+import xml.etree.ElementTree as ET
 import json
-from time import time
-from collections import OrderedDict
 
 import pytest
 from netCDF4 import Dataset
@@ -10,11 +10,16 @@ import numpy as np
 
 from tds_utils.find_ncml import find_ncml_references
 from tds_utils.find_netcdf import find_netcdf_references
-from tds_utils.xml_utils import element_to_string
+from tds_utils.xml_utils import (element_to_string, element_to_file,
+                                 find_by_tagname)
 from tds_utils.aggregation import (create_aggregation, AggregationError,
                                    OverlappingUnitsError, BaseAggregationCreator,
                                    BaseDatasetReader, AggregationType,
-                                   NcMLVariable, AggregatedGlobalAttr)
+                                   NcMLVariable, AggregatedGlobalAttr,
+                                   AggregationCreator, NetcdfDatasetReader,
+                                   CoordCache)
+from tds_utils.aggregation.aggregate import coords_to_string
+from tds_utils.aggregation.dataset_list import DatasetList
 from tds_utils.partition_files import partition_files
 from tds_utils.cache_remote_aggregations import AggregationCacher
 from tds_utils.create_catalog import get_catalog_name, CatalogBuilder
@@ -30,28 +35,44 @@ def assert_valid_xml(xml_string):
         assert False, "Invalid XML"
 
 
+@pytest.fixture(scope="session")
+def corpus(tmp_path_factory):
+    """
+    Paths to NetCDF files 'ds_0.nc' to 'ds_4.nc', where file i has the single
+    time value i. The files are created once and shared between tests, so must
+    not be modified
+    """
+    tmp_path = tmp_path_factory.mktemp("corpus")
+    return [TestAggregationCreation.netcdf_file(tmp_path, "ds_{}.nc".format(i),
+                                                values=[i])
+            for i in range(5)]
+
+
 class TestAggregationCreation(object):
 
-    def netcdf_file(self, tmpdir, filename, dim="time", values=[1234],
-                    units=None, global_attrs=None):
+    @staticmethod
+    def netcdf_file(tmp_path, filename, dim="time", values=[1234],
+                    units=None, global_attrs=None, format="NETCDF3_CLASSIC"):
         """
         Create a NetCDF file containing a single dimension. Return the path
         at which the dataset is saved.
         """
-        path = str(tmpdir.join(filename))
-        ds = Dataset(path, "w")
+        path = str(tmp_path / filename)
+        # NetCDF-3 files are much quicker to create than NetCDF-4/HDF5 files,
+        # so are used by default
+        ds = Dataset(path, "w", format=format)
         ds.createDimension(dim, None)
         var = ds.createVariable(dim, np.float32, (dim,))
         if units:
             var.units = units
-        var[:] = values
+        var[:] = np.asarray(values, dtype=np.float32)
         if global_attrs:
             for attr, value in global_attrs.items():
                 setattr(ds, attr, value)
         ds.close()
         return path
 
-    def test_different_time_units(self, tmpdir):
+    def test_different_time_units(self, tmp_path):
         """
         Check that the 'timeUnitsChange' attribute is present on the
         aggregation when files have different time units and time coordinates
@@ -69,22 +90,22 @@ class TestAggregationCreation(object):
         ]
 
         for filename, units in diff_files:
-            self.netcdf_file(tmpdir, filename, units=units)
+            self.netcdf_file(tmp_path, filename, units=units)
         for i, (filename, units) in enumerate(same_files):
-            self.netcdf_file(tmpdir, filename, units=units, values=[i])
+            self.netcdf_file(tmp_path, filename, units=units, values=[i])
 
         # timeUnitsChange should be present in the aggregation with different
         # time units...
-        diff_agg = create_aggregation([tmpdir.join(fname) for fname, _ in diff_files],
+        diff_agg = create_aggregation([tmp_path / fname for fname, _ in diff_files],
                                       "time", cache=True)
-        diff_agg_el = list(diff_agg)[0]
+        diff_agg_el = next(iter(diff_agg))
         assert "timeUnitsChange" in diff_agg_el.attrib
         assert diff_agg_el.attrib["timeUnitsChange"] == "true"
 
         # ...but not present otherwise
-        same_agg = create_aggregation([tmpdir.join(fname) for fname, _ in same_files],
+        same_agg = create_aggregation([tmp_path / fname for fname, _ in same_files],
                                       "time", cache=True)
-        same_agg_el = list(same_agg)[0]
+        same_agg_el = next(iter(same_agg))
         assert "timeUnitsChange" not in same_agg_el.attrib
 
         # Check coordValue is not present for the different units aggregation
@@ -117,22 +138,42 @@ class TestAggregationCreation(object):
             '  </anotherelement>',
             '</parent>'
         ]
-        assert xml == os.linesep.join(lines)
-
-    def test_aggregation(self, tmpdir):
+        assert xml == "\n".join(lines)
+
+        # Writing to a file should give the same output, at any indentation
+        for indentation in (0, 2):
+            buf = io.StringIO()
+            element_to_file(el, buf, indentation=indentation)
+            assert buf.getvalue() == element_to_string(el, indentation)
+
+        # Special characters should be escaped
+        el = ET.Element("el", attr='a "quoted" <value> & more')
+        el.text = "x < y & y > z"
+        parsed = ET.fromstring(element_to_string(el))
+        assert parsed.attrib == el.attrib
+        assert parsed.text.strip() == el.text
+
+        # Documents deeper than the recursion limit should be supported
+        el = ET.Element("el")
+        parent = el
+        for _ in range(sys.getrecursionlimit() + 1):
+            parent = ET.SubElement(parent, "el")
+        lines = element_to_string(el).split("\n")
+        assert lines[-1] == "</el>"
+        assert len(lines) == 2 * (sys.getrecursionlimit() + 1) + 2
+
+    def test_aggregation(self, corpus):
         """
         Test that the method to create an NcML aggregation includes references
         to the all the input files and the expected attributes are present
         with correct values
         """
-        n = 5
+        n = len(corpus)
         filenames = ["ds_{}.nc".format(i) for i in range(n)]
         coord_values = list(range(n))
-        files = [self.netcdf_file(tmpdir, filename, values=[val])
-                 for filename, val in zip(filenames, coord_values)]
 
-        agg = create_aggregation(files, "time", cache=True)
-        agg_el = list(agg)[0]
+        agg = create_aggregation(corpus, "time", cache=True)
+        agg_el = next(iter(agg))
         netcdf_els = agg_el.findall("netcdf")
 
         assert len(netcdf_els) == n
@@ -143,46 +184,287 @@ class TestAggregationCreation(object):
             assert el.attrib["location"].endswith(filenames[i])
             assert el.attrib["coordValue"] == str(float(expected_value))
 
-    def test_multiple_coord_vaules(self, tmpdir):
-        f = self.netcdf_file(tmpdir, "f", values=[1, 2, 3])
+    @pytest.mark.parametrize("format", ["NETCDF3_CLASSIC", "NETCDF4"])
+    def test_max_workers(self, tmp_path, format):
+        """
+        Check that reading files from multiple threads gives the same result
+        as reading them serially
+        """
+        files = [self.netcdf_file(tmp_path, "ds_{}.nc".format(i), values=[10 - i],
+                                  format=format)
+                 for i in range(10)]
+        serial = create_aggregation(files, "time", cache=True)
+        threaded = create_aggregation(files, "time", cache=True, max_workers=4)
+        assert element_to_string(serial) == element_to_string(threaded)
+
+        found_files = [el.attrib["location"]
+                       for el in next(iter(threaded)).findall("netcdf")]
+        assert found_files == files[::-1]
+
+        # Files should only be prefetched when other threads may be holding
+        # the reader lock
+        prefetched = []
+
+        class PrefetchReader(NetcdfDatasetReader):
+            def prefetch(self):
+                prefetched.append(self.filename)
+                super().prefetch()
+
+        class PrefetchCreator(AggregationCreator):
+            dataset_reader_cls = PrefetchReader
+
+        PrefetchCreator("time").create_aggregation(files, cache=True)
+        assert prefetched == []
+        PrefetchCreator("time").create_aggregation(files, cache=True,
+                                                   max_workers=4)
+        assert sorted(prefetched) == sorted(files)
+
+    def test_jobs(self, tmp_path):
+        """
+        Check that reading files in multiple processes gives the same result
+        as reading them serially
+        """
+        files = [self.netcdf_file(tmp_path, "ds_{}.nc".format(i), values=[10 - i],
+                                  global_attrs={"lat_max": float(i)})
+                 for i in range(10)]
+        files.append(self.netcdf_file(tmp_path, "no-time.nc", dim="not-time"))
+        attr_aggs = [AggregatedGlobalAttr(attr="lat_max", callback=max)]
+        cache = CoordCache(str(tmp_path / "coords.sqlite"))
+
+        serial = create_aggregation(files, "time", cache=True)
+        parallel = create_aggregation(files, "time", cache=True, jobs=2,
+                                      coord_cache=cache)
+        assert element_to_string(serial) == element_to_string(parallel)
+
+        with_attrs = create_aggregation(files, "time", cache=True, jobs=3,
+                                        attr_aggs=attr_aggs)
+        assert with_attrs.find("attribute").attrib["value"] == "9.0"
+
+    def test_dataset_list(self, corpus):
+        """
+        Check that adding files one at a time or all at once gives the same
+        list, in order of coordinate values
+        """
+        files = corpus[::-1]
+        expected = [(f, [float(i)]) for i, f in enumerate(corpus)]
+
+        one_by_one = DatasetList("time", NetcdfDatasetReader)
+        for f in files:
+            one_by_one.add(f)
+        assert [(f, list(v)) for f, v in one_by_one.datasets()] == expected
+
+        for kwargs in ({}, {"max_workers": 2}):
+            all_at_once = DatasetList("time", NetcdfDatasetReader)
+            all_at_once.add_many(files, **kwargs)
+            assert [(f, list(v)) for f, v in all_at_once.datasets()] == expected
+
+    @pytest.mark.parametrize("in_memory", [False, True])
+    def test_coord_cache(self, tmp_path, in_memory):
+        """
+        Check that files are not opened again when their coordinate values
+        are in the cache, unless the file has changed
+        """
+        opened = []
+
+        class CountingReader(NetcdfDatasetReader):
+            def __enter__(self):
+                opened.append(self.filename)
+                return super().__enter__()
+
+        class CountingCreator(AggregationCreator):
+            dataset_reader_cls = CountingReader
+
+        f1 = self.netcdf_file(tmp_path, "f1.nc", values=[1, 2])
+        f2 = self.netcdf_file(tmp_path, "f2.nc", values=[3])
+        if in_memory:
+            cache = CoordCache(CoordCache.IN_MEMORY)
+        else:
+            cache = CoordCache(str(tmp_path / "cache" / "coords.sqlite"))
+
+        def get_coord_values():
+            agg = CountingCreator("time").create_aggregation(
+                [f2, f1], cache=True, coord_cache=cache
+            )
+            return [el.attrib["coordValue"]
+                    for el in next(iter(agg)).findall("netcdf")]
+
+        assert get_coord_values() == ["1.0,2.0", "3.0"]
+        assert sorted(opened) == [f1, f2]
+
+        opened.clear()
+        assert get_coord_values() == ["1.0,2.0", "3.0"]
+        assert opened == []
+
+        # Modifying a file should invalidate its cache entry
+        self.netcdf_file(tmp_path, "f2.nc", values=[3, 4, 5])
+        assert get_coord_values() == ["1.0,2.0", "3.0,4.0,5.0"]
+        assert opened == [f2]
+
+    def test_coord_pattern(self, tmp_path):
+        """
+        Check that coordinate values can be parsed from filenames without
+        opening the files
+        """
+        files = ["/not/a/file_20190402.nc", "/not/a/file_20190401.nc",
+                 "/not/a/file_1.5.nc", "/not/a/file_without_date.nc"]
+        agg = create_aggregation(files, "time", cache=True,
+                                 coord_pattern=r"_(?P<coord>[\d.]+)\.nc$")
+        netcdf_els = next(iter(agg)).findall("netcdf")
+        assert [el.attrib["location"] for el in netcdf_els] == [
+            "/not/a/file_1.5.nc", "/not/a/file_20190401.nc",
+            "/not/a/file_20190402.nc"
+        ]
+        assert [el.attrib["coordValue"] for el in netcdf_els] == [
+            "1.5", "20190401", "20190402"
+        ]
+
+        # Multiple patterns: the first one that matches should be used
+        files = ["/not/a/file_20190402.nc", "/other/3_file.nc",
+                 "/not/a/file_20190401.nc"]
+        agg = create_aggregation(files, "time", cache=True, coord_pattern=[
+            r"_(?P<coord>\d+)\.nc$", r"/(?P<coord>\d+)_[^/]*$"
+        ])
+        netcdf_els = next(iter(agg)).findall("netcdf")
+        assert [el.attrib["location"] for el in netcdf_els] == [
+            "/other/3_file.nc", "/not/a/file_20190401.nc",
+            "/not/a/file_20190402.nc"
+        ]
+
+        with pytest.raises(ValueError):
+            create_aggregation(files, "time", cache=True,
+                               coord_pattern=r"_(\d+)\.nc$")
+        with pytest.raises(ValueError):
+            create_aggregation(files, "time", cache=True, coord_pattern=[
+                r"_(?P<coord>\d+)\.nc$", r"_(\d+)\.nc$"
+            ])
+
+    def test_write_aggregation(self, tmp_path):
+        """
+        Check that writing an aggregation to a file gives the same output as
+        converting the created root element to a string
+        """
+        class ExtraVariableCreator(AggregationCreator):
+            extra_variables = [
+                NcMLVariable(name="test-var", shape="time", type="int",
+                             attrs={"units": "seconds since the big bang"})
+            ]
+
+        class ProcessingCreator(ExtraVariableCreator):
+            def process_root_element(self, root):
+                ET.SubElement(root, "someextraelement")
+                aggregation = root.find("aggregation")
+                ET.SubElement(aggregation, "variableAgg", name="tas")
+                for el in aggregation.iterfind("netcdf"):
+                    el.set("ncoords", "2")
+                return root
+
+        files = [self.netcdf_file(tmp_path, "ds_{}.nc".format(i), values=[i, i + 0.5])
+                 for i in range(3)]
+        for cls in (ExtraVariableCreator, ProcessingCreator):
+            c = cls("time")
+            for cache in (True, False):
+                kwargs = {"cache": cache, "global_attrs": {"title": "hello"},
+                          "remove_attrs": ["history"]}
+                buf = io.StringIO()
+                # Pass an iterator for the file list to check it is only
+                # iterated over once
+                c.write_aggregation(iter(files), buf, **kwargs)
+                expected = element_to_string(c.create_aggregation(files, **kwargs))
+                assert buf.getvalue() == expected
+
+            # Elements added in process_root_element() should be written
+            if cls is ProcessingCreator:
+                assert '<variableAgg name="tas"/>' in expected
+                assert 'ncoords="2"' in expected
+
+            # An empty aggregation should use a self-closing tag
+            buf = io.StringIO()
+            c.write_aggregation([], buf)
+            assert buf.getvalue() == element_to_string(c.create_aggregation([]))
+
+        # Coordinate values that are not numbers should be escaped
+        class StringReader(BaseDatasetReader):
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args, **kwargs):
+                pass
+
+            def get_coord_values(self, dimension):
+                return ("some units", [self.filename + ' & "b"'])
+
+        class StringCreator(BaseAggregationCreator):
+            aggregation_type = AggregationType.JOIN_NEW
+            dataset_reader_cls = StringReader
+
+        c = StringCreator("time")
+        names = ["2019-01-01T00:00", "2019-01-02T00:00"]
+        buf = io.StringIO()
+        c.write_aggregation(names, buf, cache=True)
+        expected = element_to_string(c.create_aggregation(names, cache=True))
+        assert buf.getvalue() == expected
+        netcdf_els = next(iter(ET.fromstring(buf.getvalue())))
+        assert [el.attrib["coordValue"] for el in netcdf_els] == [
+            '2019-01-01T00:00 & "b"', '2019-01-02T00:00 & "b"'
+        ]
+
+    def test_coords_to_string(self):
+        values = [0.1, 1.5, 1e20, -3]
+        for dtype in (np.float32, np.float64):
+            arr = np.array(values, dtype=dtype)
+            assert coords_to_string(arr) == ",".join(map(str, arr))
+        assert coords_to_string([135.1, 2]) == "135.1,2.0"
+        for dtype in (np.int32, np.int64, np.uint16):
+            arr = np.array([0, 7, 3600], dtype=dtype)
+            assert coords_to_string(arr) == "0,7,3600"
+
+    def test_multiple_coord_vaules(self, tmp_path):
+        f = self.netcdf_file(tmp_path, "f", values=[1, 2, 3])
         agg = create_aggregation([f], "time", cache=True)
-        agg_el = list(agg)[0]
+        agg_el = next(iter(agg))
         netcdf_els = agg_el.findall("netcdf")
         assert len(netcdf_els) == 1
         assert netcdf_els[0].attrib["coordValue"] == "1.0,2.0,3.0"
 
-    def test_file_order(self, tmpdir):
+        # Values should be sorted if they are not in ascending order in the
+        # file
+        for values in ([3, 2, 1], [2, 3, 1]):
+            f = self.netcdf_file(tmp_path, "f", values=values)
+            agg = create_aggregation([f], "time", cache=True)
+            netcdf_els = next(iter(agg)).findall("netcdf")
+            assert netcdf_els[0].attrib["coordValue"] == "1.0,2.0,3.0"
+
+    def test_file_order(self, corpus):
         """
         Test that the file list in the NcML aggregation is sorted in time order
         when cache=True, and in the order given otherwise
         """
-        f1 = self.netcdf_file(tmpdir, "ds_1.nc", values=[300])
-        f2 = self.netcdf_file(tmpdir, "ds_2.nc", values=[10])
+        f1 = corpus[3]
+        f2 = corpus[1]
 
         # Give file list in reverse order - result should be sorted
         agg = create_aggregation([f1, f2], "time", cache=True)
-        found_files = [el.attrib["location"] for el in list(agg)[0].findall("netcdf")]
+        found_files = [el.attrib["location"] for el in next(iter(agg)).findall("netcdf")]
         assert found_files == [f2, f1]
 
         # Don't cache coordinate values - should stay in the wrong order
         agg2 = create_aggregation([f1, f2], "time", cache=False)
-        found_files2 = [el.attrib["location"] for el in list(agg2)[0].findall("netcdf")]
+        found_files2 = [el.attrib["location"] for el in next(iter(agg2)).findall("netcdf")]
         assert found_files2 == [f1, f2]
 
-    def test_multiple_time_values_sorting(self, tmpdir):
+    def test_multiple_time_values_sorting(self, tmp_path):
         """
         Check that files are sorted correctly when they have multiple time
         values
         """
         def get_sorted(*args):
-            suffix = "{}.nc".format(time())
             filenames = []
             for i, (filename, val) in enumerate(args):
-                filenames.append(self.netcdf_file(tmpdir, filename, values=val))
+                filenames.append(self.netcdf_file(tmp_path, filename, values=val))
 
             agg = create_aggregation(filenames, "time", cache=True)
             return [os.path.basename(el.attrib["location"])
-                    for el in list(agg)[0].findall("netcdf")]
+                    for el in next(iter(agg)).findall("netcdf")]
 
         # Simple cases
         assert get_sorted(("f1", [10]), ("f2", [20, 30])) == ["f1", "f2"]
@@ -197,67 +479,63 @@ class TestAggregationCreation(object):
                          ("f11", [5, 6, 7]))
         assert got == ["f11", "f9", "f10"]
 
-    def test_overlapping_time_values(self, tmpdir):
+    @pytest.mark.parametrize("values", [
+        # One time range is fully contained within the other
+        ([10, 20, 30], [15, 16]),
+        # Ranges overlap but not entirely
+        ([10, 20, 30], [5, 15]),
+        # Time values are repeated
+        ([10], [10]),
+        ([10, 20], [20, 21]),
+        # More than two ranges
+        ([10, 20], [30, 40], [25, 60])
+    ])
+    def test_overlapping_time_values(self, tmp_path, values):
         """
         Check that an error is raised when files have overlapping time values
         and cache=True
         """
-        def do_test(*values):
-            suffix = "{}.nc".format(time())
-            filenames = []
-            for i, val in enumerate(values):
-                filename = "f{}_{}".format(i, suffix)
-                filenames.append(self.netcdf_file(tmpdir, filename, values=val))
-
-            with pytest.raises(OverlappingUnitsError):
-                create_aggregation(filenames, "time", cache=True)
+        filenames = [self.netcdf_file(tmp_path, "f{}.nc".format(i), values=val)
+                     for i, val in enumerate(values)]
 
-        # Test when one time range is fully contained within the other
-        do_test([10, 20, 30], [15, 16])
-        # when ranges overlap but not entirely
-        do_test([10, 20, 30], [5, 15])
-        # when time values are repeated
-        do_test([10], [10])
-        do_test([10, 20], [20, 21])
-        # more than two ranges
-        do_test([10, 20], [30, 40], [25, 60])
+        with pytest.raises(OverlappingUnitsError):
+            create_aggregation(filenames, "time", cache=True)
 
-    def test_no_caching(self, tmpdir):
+    def test_no_caching(self, corpus):
         """
         Check that files are not opened if cache=False when creating an
         aggregation
         """
-        f = self.netcdf_file(tmpdir, "ds.nc")
         try:
-            create_aggregation([f], "nonexistantdimension", cache=False)
+            create_aggregation(corpus[:1], "nonexistantdimension", cache=False)
         except AggregationError as ex:
             assert False, "Unexpected error: {}".format(ex)
 
-    def test_some_files_fail(self, tmpdir):
+    def test_some_files_fail(self, tmp_path):
         """
         Check that an aggregation is still created if some (but not all) files
         are invalid
         """
-        no_time = self.netcdf_file(tmpdir, "no-time.nc", dim="not-time")
-        time = self.netcdf_file(tmpdir, "time.nc", dim="time")
+        no_time = self.netcdf_file(tmp_path, "no-time.nc", dim="not-time")
+        time = self.netcdf_file(tmp_path, "time.nc", dim="time")
         try:
             agg = create_aggregation([no_time, time], "time", cache=True)
             found_files = [el.attrib["location"]
-                           for el in list(agg)[0].findall("netcdf")]
+                           for el in next(iter(agg)).findall("netcdf")]
             assert found_files == [time]
         except AggregationError as ex:
             assert False, "Unexpected error: {}".format(ex)
 
-    def test_all_files_fail(self, tmpdir):
+    def test_all_files_fail(self, tmp_path):
         """
         Check an exception is thrown if all files are invalid
         """
-        no_time = self.netcdf_file(tmpdir, "no-time.nc", dim="not-time")
-        no_time2 = self.netcdf_file(tmpdir, "no-time2.nc", dim="not-time")
+        no_time = self.netcdf_file(tmp_path, "no-time.nc", dim="not-time")
+        no_time2 = self.netcdf_file(tmp_path, "no-time2.nc", dim="not-time")
         with pytest.raises(AggregationError):
             create_aggregation([no_time, no_time2], "time", cache=True)
 
-    def test_custom_agg_creator_cls(self, tmpdir):
+    def test_custom_agg_creator_cls(self, tmp_path):
         class CustomReaderClass(BaseDatasetReader):
             def __enter__(self):
                 self.f = open(self.filename)
@@ -284,13 +562,13 @@ class TestAggregationCreation(object):
 
         c = CustomAggTypeCreator("time")
 
-        f1 = tmpdir.join("f1")
-        f2 = tmpdir.join("f2")
-        f1.write("135.1")
-        f2.write("235.2")
+        f1 = tmp_path / "f1"
+        f2 = tmp_path / "f2"
+        f1.write_text("135.1")
+        f2.write_text("235.2")
 
         agg = c.create_aggregation(map(str, [f1, f2]), cache=True)
-        agg_el = agg.findall("aggregation")[0]
+        agg_el = agg.find("aggregation")
         assert "type" in agg_el.attrib
         assert agg_el.attrib["type"] == "joinNew"
 
@@ -312,19 +590,19 @@ class TestAggregationCreation(object):
         # Check extra processing was performed
         assert len(agg.findall("someextraelement")) == 1
 
-    def test_attribute_aggregation(self, tmpdir):
+    def test_attribute_aggregation(self, tmp_path):
         files = [
-            self.netcdf_file(tmpdir, "f1.nc", values=[1], global_attrs={
+            self.netcdf_file(tmp_path, "f1.nc", values=[1], global_attrs={
                 "foobar": 1.0,
                 "lat_min": -40.0,
                 "lat_max": 90.0
             }),
-            self.netcdf_file(tmpdir, "f2.nc", values=[2], global_attrs={
+            self.netcdf_file(tmp_path, "f2.nc", values=[2], global_attrs={
                 "foobar": 1.0,
                 "lat_min": -1.0,
                 "lat_max": 10.0
             }),
-            self.netcdf_file(tmpdir, "f3.nc", values=[3], global_attrs={
+            self.netcdf_file(tmp_path, "f3.nc", values=[3], global_attrs={
                 "foobar": 4.0,
                 "lat_min": -85.0,
                 "lat_max": 10.0
@@ -351,13 +629,20 @@ class TestAggregationCreation(object):
             "name": "foobar", "value": "2.0", "type": "float"
         }
 
-    def test_global_attributes(self, tmpdir):
-        nc = self.netcdf_file(tmpdir, "f.nc")
-        global_attrs = OrderedDict()
-        global_attrs["mystring"] = "hello"
-        global_attrs["myinteger"] = 4
-        global_attrs["numpyinteger"] = np.int64(123456)
-        global_attrs["myfloat"] = np.float32(42)
+        # Coordinate values are not written without cache=True
+        netcdf_els = agg[-1].findall("netcdf")
+        assert len(netcdf_els) == 3
+        for el in netcdf_els:
+            assert "coordValue" not in el.attrib
+
+    def test_global_attributes(self, tmp_path):
+        nc = self.netcdf_file(tmp_path, "f.nc")
+        global_attrs = {
+            "mystring": "hello",
+            "myinteger": 4,
+            "numpyinteger": np.int64(123456),
+            "myfloat": np.float32(42)
+        }
         root = create_aggregation([str(nc)], "time",
                                   global_attrs=global_attrs)
         attribute_els = root.findall("attribute")
@@ -373,8 +658,8 @@ class TestAggregationCreation(object):
             "name": "myfloat", "value": "42.0", "type": "float"
         }
 
-    def test_remove_global_attributes(self, tmpdir):
-        nc = self.netcdf_file(tmpdir, "f.nc")
+    def test_remove_global_attributes(self, tmp_path):
+        nc = self.netcdf_file(tmp_path, "f.nc")
         root = create_aggregation(
             [str(nc)], "time", remove_attrs=["bad-attribute", "even-worse-attribute"]
         )
@@ -384,55 +669,66 @@ class TestAggregationCreation(object):
         assert remove_els[1].attrib == {"name": "bad-attribute", "type": "attribute"}
 
 
+@pytest.fixture(scope="module")
+def partitioned():
+    """
+    Result of partitioning the files in TestPartitioning.all_files, which is
+    shared between the partitioning tests
+    """
+    return partition_files(TestPartitioning.all_files)
+
+
 class TestPartitioning(object):
-    def test_partition(self):
-        """
-        Test the algorithm to detect dates in file paths and partition a list
-        into groups
-        """
-        all_files = [
+    """
+    Test the algorithm to detect dates in file paths and partition a list into
+    groups
+    """
+    all_files = [
+        "/path/one/2018/01/01/f1.nc",
+        "/path/one/2018/01/02/f2.nc",
+        "/path/two/2019/01/01/f3.nc",
+        # Paths only differ by digits but one of the changes is version
+        # number - check they get split into two
+        "/path/three/v1/2009/01/01/f4.nc",
+        "/path/three/v1/2008/01/01/f5.nc",
+        "/path/three/v2/2009/01/01/f6.nc",
+        # Same as above but with no alphabetic characters in version
+        "/path/four/1.0/2007/01/01/f7.nc",
+        "/path/four/1.0/2003/01/01/f8.nc",
+        "/path/four/2.0/2007/01/01/f9.nc"
+    ]
+
+    expected_partitions = [
+        ("/path/one/xxxx/xx/xx", [
             "/path/one/2018/01/01/f1.nc",
-            "/path/one/2018/01/02/f2.nc",
-            "/path/two/2019/01/01/f3.nc",
-            # Paths only differ by digits but one of the changes is version
-            # number - check they get split into two
+            "/path/one/2018/01/02/f2.nc"
+        ]),
+        ("/path/two/xxxx/xx/xx", ["/path/two/2019/01/01/f3.nc"]),
+        ("/path/three/v1/xxxx/xx/xx", [
             "/path/three/v1/2009/01/01/f4.nc",
-            "/path/three/v1/2008/01/01/f5.nc",
-            "/path/three/v2/2009/01/01/f6.nc",
-            # Same as above but with no alphabetic characters in version
+            "/path/three/v1/2008/01/01/f5.nc"
+        ]),
+        ("/path/three/v2/xxxx/xx/xx", ["/path/three/v2/2009/01/01/f6.nc"]),
+        ("/path/four/1.0/xxxx/xx/xx", [
             "/path/four/1.0/2007/01/01/f7.nc",
-            "/path/four/1.0/2003/01/01/f8.nc",
-            "/path/four/2.0/2007/01/01/f9.nc"
-        ]
-
-        expected_part = {
-            "/path/one/xxxx/xx/xx": [
-                "/path/one/2018/01/01/f1.nc",
-                "/path/one/2018/01/02/f2.nc"
-            ],
-            "/path/two/xxxx/xx/xx": ["/path/two/2019/01/01/f3.nc"],
-
-            "/path/three/v1/xxxx/xx/xx": [
-                "/path/three/v1/2009/01/01/f4.nc",
-                "/path/three/v1/2008/01/01/f5.nc"
-            ],
-
-            "/path/three/v2/xxxx/xx/xx": ["/path/three/v2/2009/01/01/f6.nc"],
+            "/path/four/1.0/2003/01/01/f8.nc"
+        ]),
+        ("/path/four/2.0/xxxx/xx/xx", ["/path/four/2.0/2007/01/01/f9.nc"])
+    ]
 
-            "/path/four/1.0/xxxx/xx/xx": [
-                "/path/four/1.0/2007/01/01/f7.nc",
-                "/path/four/1.0/2003/01/01/f8.nc"
-            ],
+    def test_partition_names(self, partitioned):
+        expected = [name for name, _ in self.expected_partitions]
+        assert list(partitioned.keys()) == expected
 
-            "/path/four/2.0/xxxx/xx/xx": ["/path/four/2.0/2007/01/01/f9.nc"]
-        }
-        assert partition_files(all_files) == expected_part
+    @pytest.mark.parametrize("name,files", expected_partitions)
+    def test_partition(self, partitioned, name, files):
+        assert partitioned[name] == files
 
 
 class TestAggregationCaching(object):
-    def test_get_agg_url(self, tmpdir):
-        json_file = tmpdir.join("ds.json")
-        json_file.write(json.dumps({
+    def test_get_agg_url(self, tmp_path):
+        json_file = tmp_path / "ds.json"
+        json_file.write_text(json.dumps({
             "opendap-dataset": {
                 "generate_aggregation": True,
                 "include_in_wms": False,
@@ -457,28 +753,26 @@ class TestAggregationCaching(object):
 
 
 class TestNcmlFinder(object):
-    def test_no_ncml(self, tmpdir):
+    def test_no_ncml(self):
         """
         Check that no paths are returned if no NcML files are referenced in the
         XML
         """
-        catalog = tmpdir.join("catalog.xml")
-        catalog.write("""
+        catalog = io.BytesIO(b"""
             <?xml version="1.0" encoding="UTF-8"?>
             <catalog>
                 <dataset name="some.dataset" ID="some.dataset">
                 </dataset>
             </catalog>
         """.strip())
-        got = list(find_ncml_references(str(catalog)))
+        got = list(find_ncml_references(catalog))
         assert got == []
 
-    def test_ncml_present(self, tmpdir):
+    def test_ncml_present(self):
         """
         Check paths are returned when expected
         """
-        catalog = tmpdir.join("catalog.xml")
-        catalog.write("""
+        catalog = io.BytesIO(b"""
             <?xml version="1.0" encoding="UTF-8"?>
             <catalog xmlns="some-namespace1">
                 <dataset name="some.dataset" ID="some.dataset">
@@ -493,16 +787,15 @@ class TestNcmlFinder(object):
             </catalog>
         """.strip())
         expected = ["/my/ncml/aggregation.ncml", "/my/other/aggregation.ncml"]
-        got = list(find_ncml_references(str(catalog)))
+        got = list(find_ncml_references(catalog))
         assert got == expected
 
-    def test_non_netcdf_element(self, tmpdir):
+    def test_non_netcdf_element(self):
         """
         Check that other elements with a 'location' attribute are not also
         included
         """
-        catalog = tmpdir.join("catalog.xml")
-        catalog.write("""
+        catalog = io.BytesIO(b"""
             <?xml version="1.0" encoding="UTF-8"?>
             <catalog>
                 <dataset name="some.dataset" ID="some.dataset">
@@ -511,18 +804,18 @@ class TestNcmlFinder(object):
                 </dataset>
             </catalog>
         """.strip())
-        got = list(find_ncml_references(str(catalog)))
+        got = list(find_ncml_references(catalog))
         assert got == []
 
 
 class TestNetcdfFinder(object):
-    def test_netcdf_present(self, tmpdir):
+    def test_netcdf_present(self, tmp_path):
         """
         Check that a NetCDF file is found and the dataset roots are replaced
         with path on disk
         """
-        catalog = tmpdir.join("catalog.xml")
-        catalog.write("""
+        catalog = tmp_path / "catalog.xml"
+        catalog.write_text("""
             <?xml version="1.0" encoding="UTF-8"?>
             <catalog>
                 <dataset name="some.dataset1" ID="some.dataset1" urlPath="prefix1/one.nc"/>
@@ -542,20 +835,50 @@ class TestNetcdfFinder(object):
                        "prefix3/three.nc", "nested.nc"]
 
 
+    def test_find_by_tagname(self):
+        """
+        Check that elements are only returned once fully parsed, in document
+        order, unless clear=True
+        """
+        # Make the document large enough to be parsed in several chunks
+        padding = "<other/>" * 10000
+        catalog = """
+            <catalog xmlns="some-namespace">
+                <dataset name="outer">
+                    {padding}
+                    <dataset name="inner">some text</dataset>
+                    {padding}
+                    <other/>
+                </dataset>
+                <dataset name="last"/>
+            </catalog>
+        """.strip().format(padding=padding).encode()
+
+        got = []
+        for el in find_by_tagname(io.BytesIO(catalog), "dataset"):
+            got.append((el.get("name"), len(el), el.text and el.text.strip()))
+        assert got == [("outer", 20002, ""), ("inner", 0, "some text"),
+                       ("last", 0, None)]
+
+        got = [el.get("name") for el in
+               find_by_tagname(io.BytesIO(catalog), "dataset", clear=True)]
+        assert got == ["outer", "inner", "last"]
+
+
 class TestCreateCatalog(object):
-    def test_get_catalog_name(self, tmpdir):
-        with_name = tmpdir.join("catalog-with-a-name.xml")
-        with_name.write("""
+    def test_get_catalog_name(self, tmp_path):
+        with_name = tmp_path / "catalog-with-a-name.xml"
+        with_name.write_text("""
             <?xml version="1.0" encoding="UTF-8"?>
             <catalog name="some-name">
                 <dataset/>
             </catalog>
         """.strip())
 
-        no_name1 = tmpdir.join("catalog-without-a-name.xml")
-        no_name2 = tmpdir.join("catalog-with-no-name")
+        no_name1 = tmp_path / "catalog-without-a-name.xml"
+        no_name2 = tmp_path / "catalog-with-no-name"
         for cat in (no_name1, no_name2):
-            cat.write("""
+            cat.write_text("""
                 <?xml version="1.0" encoding="UTF-8"?>
                 <catalog>
                     <dataset/>
@@ -566,11 +889,21 @@ class TestCreateCatalog(object):
         assert get_catalog_name(str(no_name1)) == "catalog-without-a-name"
         assert get_catalog_name(str(no_name2)) == "catalog-with-no-name"
 
-    def test_root_catalog(self, tmpdir):
+        # Catalogs that are malformed after the root element should also be
+        # rejected
+        invalid = tmp_path / "invalid.xml"
+        truncated = tmp_path / "truncated.xml"
+        invalid.write_text("this is not XML")
+        truncated.write_text('<catalog name="some-name"><dataset>')
+        for cat in (invalid, truncated):
+            with pytest.raises(ValueError):
+                get_catalog_name(str(cat))
+
+    def test_root_catalog(self, tmp_path):
         filenames = ("one.xml", "two.xml", "three.xml")
-        catalogs = list(map(tmpdir.join, filenames))
+        catalogs = [tmp_path / filename for filename in filenames]
         for name, cat in zip(filenames, catalogs):
-            cat.write("""
+            cat.write_text("""
                 <?xml version="1.0" encoding="UTF-8"?>
                 <catalog name="{name}">
                     <dataset/>
@@ -579,7 +912,7 @@ class TestCreateCatalog(object):
 
         # Pass in absolute paths
         paths = list(map(str, catalogs))
-        root_catalog = CatalogBuilder().root_catalog(paths, str(tmpdir))
+        root_catalog = CatalogBuilder().root_catalog(paths, str(tmp_path))
         assert_valid_xml(root_catalog)
         assert "<catalogRef" in root_catalog
         # Check that paths are relative in the generated catalog
@@ -595,7 +928,7 @@ class TestCreateCatalog(object):
         for f in files:
             assert f in catalog
 
-    def test_access_methods(self, tmpdir):
+    def test_access_methods(self, tmp_path):
         def get_services(xml):
             """
             Return a set containing all service types found in the given
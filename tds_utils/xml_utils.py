@@ -1,64 +1,196 @@
 """
 Common functions for tasks to do with parsing XML documents
 """
-import os
-import re
-import xml.etree.cElementTree as ET
+import xml.etree.ElementTree as ET
 
 
-def element_to_string(element, indentation=0):
+XML_PROLOG = '<?xml version="1.0" encoding="UTF-8"?>'
+
+# Characters that must be escaped in text and (double-quoted) attribute values
+_TEXT_ESCAPES = (("&", "&amp;"), ("<", "&lt;"), (">", "&gt;"))
+_ATTR_ESCAPES = _TEXT_ESCAPES + (('"', "&quot;"), ("\n", "&#10;"),
+                                 ("\r", "&#13;"), ("\t", "&#9;"))
+
+
+def _escape(value, escapes):
+    # Most values do not contain any special characters, and checking for each
+    # one before replacing is much quicker than str.translate() in that case
+    for char, replacement in escapes:
+        if char in value:
+            value = value.replace(char, replacement)
+    return value
+
+
+def escape_text(text):
     """
-    Return a string representation of an ET.Element object with indentation and
-    line breaks.
+    Escape a string for use as the text of an XML element
+    """
+    return _escape(text, _TEXT_ESCAPES)
 
-    `indentation` is how many levels to indent the returned string (2 spaces
-    per level).
+
+def escape_attr(value):
+    """
+    Escape a string for use as a double-quoted XML attribute value
     """
-    children = ""
-    for child in element:
-        children += element_to_string(child, indentation=indentation + 1)
-        children += os.linesep
+    return _escape(value, _ATTR_ESCAPES)
+
 
-    def get_indentation(level):
-        return " " * (2 * level)
+# Indentation strings for the most common levels, so they are not rebuilt for
+# every element
+_INDENTATIONS = tuple(" " * (2 * level) for level in range(32))
 
-    indentation_str = get_indentation(indentation)
-    elem_str = "{ind}<{tag}".format(ind=indentation_str, tag=element.tag)
 
-    attrs = " ".join('{}="{}"'.format(key, value) for key, value in element.items())
+def get_indentation(level):
+    if level < len(_INDENTATIONS):
+        return _INDENTATIONS[level]
+    return " " * (2 * level)
+
+
+def _open_tag(element):
+    """
+    Return the start of the opening tag of an ET.Element object, including
+    attributes but not the closing '>'
+    """
+    elem_str = "<{tag}".format(tag=element.tag)
+    attrs = " ".join([key + '="' + escape_attr(str(value)) + '"'
+                      for key, value in element.items()])
     if attrs:
         elem_str += " " + attrs
+    return elem_str
+
+
+def start_tag(element, indentation=0):
+    """
+    Return the indented opening tag of an ET.Element object, without any
+    children or text
+    """
+    return get_indentation(indentation) + _open_tag(element) + ">"
+
+
+def end_tag(element, indentation=0):
+    """
+    Return the indented closing tag of an ET.Element object
+    """
+    return "{ind}</{tag}>".format(ind=get_indentation(indentation), tag=element.tag)
+
 
-    if children or element.text:
-        elem_str += ">" + os.linesep
+def _element_lines(element, indentation):
+    """
+    Generator yielding the lines of the string representation of an ET.Element
+    object
+    """
+    # Walk the tree with an explicit stack rather than recursion, so that the
+    # depth of the document is not limited by the recursion limit. Closing tags
+    # are pushed as strings, to be written once all children have been written
+    stack = [(element, indentation)]
+    while stack:
+        item, level = stack.pop()
+        if isinstance(item, str):
+            yield item
+            continue
 
-        if children:
-            elem_str += children
+        open_tag = get_indentation(level) + _open_tag(item)
+        if len(item):
+            yield open_tag + ">"
+            stack.append((end_tag(item, level), level))
+            stack.extend((child, level + 1) for child in reversed(item))
+        elif item.text:
+            yield open_tag + ">"
+            yield get_indentation(level + 1) + escape_text(item.text)
+            yield end_tag(item, level)
         else:
-            elem_str += get_indentation(indentation + 1) + element.text + os.linesep
+            yield open_tag + "/>"
 
-        elem_str += "{ind}</{tag}>".format(ind=indentation_str, tag=element.tag)
-    else:
-        elem_str += "/>"
 
+def element_to_string(element, indentation=0):
+    """
+    Return a string representation of an ET.Element object with indentation and
+    line breaks.
+
+    `indentation` is how many levels to indent the returned string (2 spaces
+    per level).
+    """
+    # Collect lines in a list and join them once at the end, rather than
+    # concatenating strings for each level of the tree
+    lines = []
     # If this is the top level then include <?xml?> element
     if indentation == 0:
-        prolog = '<?xml version="1.0" encoding="UTF-8"?>'
-        elem_str = prolog + os.linesep + elem_str
-    return elem_str
+        lines.append(XML_PROLOG)
+    lines.extend(_element_lines(element, indentation))
+    return "\n".join(lines)
+
+
+def element_to_file(element, f, indentation=0):
+    """
+    Write the string representation of an ET.Element object, as returned by
+    element_to_string(), to the text file object `f`.
+
+    Lines are written as they are generated, so the whole document is never
+    held in memory as one string.
+    """
+    sep = ""
+    if indentation == 0:
+        f.write(XML_PROLOG)
+        sep = "\n"
+    for line in _element_lines(element, indentation):
+        f.write(sep + line)
+        sep = "\n"
+
+
+def _localname(tag):
+    """
+    Return a tag name with its namespace (if any) removed
+    """
+    return tag.rpartition("}")[2]
 
 
-def find_by_tagname(xml_filename, tagname):
+def find_by_tagname(xml_file, tagname, clear=False):
     """
     Recursively search an XML document and return elements with the given tag
-    name
+    name, in document order. `xml_file` may be a filename or a file object
+    opened in binary mode.
+
+    The document is parsed incrementally. Elements are yielded once they have
+    been fully parsed, including their text and children.
+
+    If `clear` is True then elements are instead yielded as soon as their
+    start tag is read, and discarded once they have been parsed, so that memory
+    use does not grow with the size of the document. In this case only the
+    attributes of returned elements are guaranteed to be available.
     """
-    tree = ET.ElementTree()
-    tree.parse(xml_filename)
-    root = tree.getroot()
+    if not clear:
+        yield from _find_complete(xml_file, tagname)
+        return
+
+    # Stack of elements whose end tag has not been reached yet
+    parents = []
+    # iterparse opens (and closes) the file itself if given a filename
+    for event, el in ET.iterparse(xml_file, events=("start", "end")):
+        if event == "start":
+            if _localname(el.tag) == tagname:
+                yield el
+            parents.append(el)
+            continue
+
+        # An element that has just ended is always the last child of its
+        # parent, so can be removed cheaply
+        parents.pop()
+        if parents:
+            del parents[-1][-1]
 
-    # Regex to optionally match namspace in tag name
-    tag_regex = re.compile("({[^}]+})?" + tagname)
-    for el in root.iter():
-        if re.fullmatch(tag_regex, el.tag):
-            yield el
+
+def _find_complete(xml_file, tagname):
+    """
+    Generator for find_by_tagname() with clear=False
+    """
+    # Matching elements in document order, whose first element has not ended
+    # yet. Any later elements started before it ended, so are descendants of
+    # it and have already ended by the time it does
+    matches = []
+    for event, el in ET.iterparse(xml_file, events=("start", "end")):
+        if event == "start":
+            if _localname(el.tag) == tagname:
+                matches.append(el)
+        elif matches and el is matches[0]:
+            yield from matches
+            matches = []